@@ -3,6 +3,8 @@ from yombo.lib.devices.climate import Climate
 from yombo.core.exceptions import YomboWarning
 from yombo.utils import unit_converters
 
+from ._history import History
+
 STATUS_HOLDS_AUTO_AWAY = 'auto_away'
 
 class NEST_Thermostat(Climate):
@@ -22,6 +24,7 @@ class NEST_Thermostat(Climate):
         self.add_status_extra_any(('name'))
         self._fan_list = ['on', 'auto']
         self.__device = None  # will be filled with data from the NEST API.
+        self.history = History()  # recent samples, see history_aggregate()
 
     def _start_(self, **kwargs):
         super()._start_()
@@ -35,79 +38,98 @@ class NEST_Thermostat(Climate):
         self.__device = val
         self.update_status()
 
+    def history_aggregate(self, metric, window):
+        """
+        Get min, max, mean, slope and more for a metric over the last `window` seconds.
+
+        :param metric: One of: temperature, humidity, target_temp, running
+        :param window: Seconds to look back.
+        :return: Dictionary, or None if there is no history for the window.
+        """
+        return self.history.aggregate(metric, window)
+
     def update_status(self):
         """
         Should be called whenever we get new device status update.
         :return:
         """
-        status = self.__device['status']
+        device = self.__device['device']
         shared = self.__device['shared']
         structure = self.__device['structure']
 
         status_extra = {}
 
-        self._away = self.structure.away == 'away'
+        self._away = structure['away'] == 'away'
 
 
         # lets calculate if we are off, cool 1, cool 2, cool 3, heat 1, heat 2, heat 3
-        if status['hvac_fan_state'] is True:
+        if shared['hvac_fan_state'] is True:
             status_extra['fan'] = 'fan_only'
         else:
             status_extra['fan'] = 'off'
 
-        if status['hvac_heater_state'] is True:
+        if shared['hvac_heater_state'] is True:
             status_extra['fan'] = 'on'
             status_extra['running'] = 'heat'
-        elif status['hvac_heat_x2_state'] is True:
+        elif shared['hvac_heat_x2_state'] is True:
             status_extra['fan'] = 'on'
             status_extra['running'] = 'heat2'
-        elif status['hvac_heat_x3_state'] is True:
+        elif shared['hvac_heat_x3_state'] is True:
             status_extra['fan'] = 'on'
             status_extra['running'] = 'heat3'
-        elif status['hvac_ac_state'] is True:
+        elif shared['hvac_ac_state'] is True:
             status_extra['fan'] = 'on'
             status_extra['running'] = 'cool'
-        elif status['hvac_cool_x2_state'] is True:
+        elif shared['hvac_cool_x2_state'] is True:
             status_extra['fan'] = 'on'
             status_extra['running'] = 'cool2'
-        elif status['hvac_cool_x3_state'] is True:
+        elif shared['hvac_cool_x3_state'] is True:
             status_extra['fan'] = 'on'
             status_extra['running'] = 'cool3'
         else:
             status_extra['fan'] = 'off'
             status_extra['running'] = 'off'
 
-        status_extra['mode'] = self.current_mode_map[status['current_schedule_mode']]
+        status_extra['mode'] = self.current_mode_map.get(device['current_schedule_mode'],
+                                                         device['current_schedule_mode'].lower())
 
         if structure['away'] == False:
             status_extra['hold'] = 'away'
         else:
             status_extra['hold'] = 'home'
 
-        status_extra['humidity'] = float(status['current_humidity'])
-        status_extra['temperature'] = float(status['current_temperature'])
+        status_extra['humidity'] = float(device['current_humidity'])
+        status_extra['temperature'] = float(shared['current_temperature'])
         machine_status = float(shared['current_temperature'])
         status_extra['target_temp'] = float(shared['target_temperature'])
         status_extra['target_temp_high'] = float(shared['target_temperature_high'])
         status_extra['target_temp_low'] = float(shared['target_temperature_low'])
         status_extra['name'] = shared['name']
 
+        # Keep recent history in memory for fast trend queries.
+        self.history.add({
+            'temperature': status_extra['temperature'],
+            'humidity': status_extra['humidity'],
+            'target_temp': status_extra['target_temp'],
+            'running': 0.0 if status_extra['running'] == 'off' else 1.0,
+        })
+
         # Save statistics for long term.
         statistic_label = self.statistic_label
         if statistic_label is not None:
-            self._Statistics.averages("%s.%s" (statistic_label, 'temperature'), status_extra['temperature'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'humidity'), status_extra['humidity'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'fan'), status_extra['fan'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'running'), status_extra['running'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'hold'), status_extra['hold'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'mode'), status_extra['mode'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'target_temp_low'), status_extra['target_temp_low'], bucket_time=5)
-            self._Statistics.averages("%s.%s" (statistic_label, 'target_temp_high'), status_extra['target_temp_high'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'temperature'), status_extra['temperature'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'humidity'), status_extra['humidity'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'fan'), status_extra['fan'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'running'), status_extra['running'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'hold'), status_extra['hold'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'mode'), status_extra['mode'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'target_temp_low'), status_extra['target_temp_low'], bucket_time=5)
+            self._Statistics.averages("%s.%s" % (statistic_label, 'target_temp_high'), status_extra['target_temp_high'], bucket_time=5)
 
         if self.temperature_display() == 'f':
-            set_temp = unit_converters['c_f'](status['target_temperature_type'])
+            set_temp = unit_converters['c_f'](status_extra['target_temp'])
         else:
-            set_temp = status['target_temperature_type']
+            set_temp = status_extra['target_temp']
 
         device_status = {
             'human_status': _(
@@ -0,0 +1,216 @@
+"""
+Keeps recent temperature, humidity, setpoint, and run state history in memory. This allows rules to ask
+for things like the recent temperature slope without going to the statistics database.
+
+Each metric is stored in three tiers: raw samples, 5 minute averages, and hourly averages. Aggregates
+use the finest tier that still covers the requested window.
+
+License
+=======
+
+Feel free to use or copy under the MIT license.
+
+The Yombo team and other contributors hopes that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:copyright: Copyright 2016 by Yombo.
+"""
+# Import python libraries
+from array import array
+import time
+
+HISTORY_METRICS = ('temperature', 'humidity', 'target_temp', 'running')
+
+# (name, bucket size in seconds, capacity). A bucket size of 0 keeps every sample.
+HISTORY_TIERS = (
+    ('raw', 0, 720),
+    ('5min', 300, 288),  # 24 hours
+    ('hourly', 3600, 168),  # 7 days
+)
+
+
+class RingBuffer(object):
+    """
+    Fixed size buffer of (time, value) pairs, stored in arrays of doubles. The oldest sample is overwritten
+    once full.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', [0.0] * capacity)
+        self.values = array('d', [0.0] * capacity)
+        self.head = 0  # Where the next sample goes.
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def oldest(self):
+        """
+        Returns the time of the oldest sample, or None if empty.
+        """
+        if self.count == 0:
+            return None
+        return self.times[(self.head - self.count) % self.capacity]
+
+    def since(self, start):
+        """
+        Yields (time, value) pairs newer than start, newest first.
+        """
+        index = self.head
+        for i in range(self.count):
+            index = (index - 1) % self.capacity
+            if self.times[index] < start:
+                return
+            yield self.times[index], self.values[index]
+
+
+class MetricHistory(object):
+    """
+    History for a single metric, in all tiers.
+    """
+    def __init__(self):
+        self.first_sample = None  # Time of the very first sample, bucket start times are rounded down.
+        self.tiers = []
+        for name, bucket, capacity in HISTORY_TIERS:
+            self.tiers.append({
+                'name': name,
+                'bucket': bucket,
+                'buffer': RingBuffer(capacity),
+                'bucket_start': None,
+                'sum': 0.0,
+                'count': 0,
+            })
+
+    def add(self, value, timestamp):
+        if self.first_sample is None:
+            self.first_sample = timestamp
+        for tier in self.tiers:
+            if tier['bucket'] == 0:
+                tier['buffer'].append(timestamp, value)
+                continue
+            bucket_start = timestamp - (timestamp % tier['bucket'])
+            if tier['bucket_start'] != bucket_start:
+                self.close_bucket(tier)
+                tier['bucket_start'] = bucket_start
+            tier['sum'] += value
+            tier['count'] += 1
+
+    def close_bucket(self, tier):
+        if tier['count'] > 0:
+            tier['buffer'].append(tier['bucket_start'], tier['sum'] / tier['count'])
+        tier['sum'] = 0.0
+        tier['count'] = 0
+
+    def oldest(self, tier):
+        """
+        Returns the time of the oldest data held by a tier, including the bucket still being filled. Bucket start
+        times are limited to the first sample so that coarse tiers don't appear to go back further than they do.
+        """
+        oldest = tier['buffer'].oldest()
+        if oldest is None and tier['count'] > 0:
+            oldest = tier['bucket_start']
+        if oldest is None:
+            return None
+        return max(oldest, self.first_sample)
+
+    def aggregate(self, window, now):
+        """
+        Calculate count, min, max, mean, first, last and slope (per hour) for the last `window` seconds.
+
+        :param window: Seconds to look back.
+        :param now: Current time.
+        :return: Dictionary, or None if there are no samples in the window.
+        """
+        start = now - window
+        tier = None
+        for candidate in self.tiers:
+            oldest = self.oldest(candidate)
+            if oldest is not None and oldest <= start:
+                tier = candidate
+                break
+        if tier is None:  # Nothing covers the whole window, use the finest tier holding the most history.
+            tier = self.tiers[0]
+            for candidate in self.tiers[1:]:
+                oldest = self.oldest(candidate)
+                if oldest is not None and (self.oldest(tier) is None or oldest < self.oldest(tier)):
+                    tier = candidate
+
+        samples = list(tier['buffer'].since(start))
+        if tier['count'] > 0 and tier['bucket_start'] >= start:  # Include the bucket still being filled.
+            samples.insert(0, (tier['bucket_start'], tier['sum'] / tier['count']))
+        if len(samples) == 0:
+            return None
+
+        count = len(samples)
+        total_time = 0.0
+        total_value = 0.0
+        minimum = samples[0][1]
+        maximum = samples[0][1]
+        for timestamp, value in samples:
+            total_time += timestamp
+            total_value += value
+            if value < minimum:
+                minimum = value
+            if value > maximum:
+                maximum = value
+        mean_time = total_time / count
+        mean = total_value / count
+
+        slope = 0.0
+        if count > 1:
+            numerator = 0.0
+            denominator = 0.0
+            for timestamp, value in samples:
+                numerator += (timestamp - mean_time) * (value - mean)
+                denominator += (timestamp - mean_time) ** 2
+            if denominator > 0:
+                slope = numerator / denominator * 3600
+
+        return {
+            'tier': tier['name'],
+            'count': count,
+            'min': minimum,
+            'max': maximum,
+            'mean': mean,
+            'first': samples[-1][1],
+            'last': samples[0][1],
+            'slope_per_hour': slope,
+        }
+
+
+class History(object):
+    """
+    History for a device or structure, one MetricHistory per metric.
+    """
+    def __init__(self):
+        self.metrics = {metric: MetricHistory() for metric in HISTORY_METRICS}
+        self.latest = {}
+
+    def add(self, values, timestamp=None):
+        """
+        Record a sample for each metric included in values. Run state should be 1.0 when running and 0.0
+        when not, so the mean is the fraction of time running.
+
+        :param values: Dictionary of metric: value.
+        :param timestamp: Time of the sample, defaults to now.
+        :return:
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        for metric, value in values.items():
+            if metric in self.metrics and value is not None:
+                self.metrics[metric].add(float(value), timestamp)
+                self.latest[metric] = float(value)
+
+    def aggregate(self, metric, window, now=None):
+        if metric not in self.metrics:
+            raise KeyError("Unknown history metric: %s" % metric)
+        if now is None:
+            now = time.time()
+        return self.metrics[metric].aggregate(window, now)
@@ -0,0 +1,54 @@
+"""
+Time helpers shared by the NEST module and poll_worker.py. This must not import anything from yombo, the
+poll workers run outside of the gateway.
+
+License
+=======
+
+Feel free to use or copy under the MIT license.
+
+The Yombo team and other contributors hopes that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:copyright: Copyright 2016 by Yombo.
+"""
+# Import python libraries
+import calendar
+from datetime import timezone
+import time
+
+MONTH_MAP = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+def parse_expires_in(value):
+    """
+    Convert the 'expires_in' value from a NEST login to seconds since the epoch (UTC).
+
+    NEST uses a fixed format, such as 'Sat, 28-Jan-2017 21:04:34 GMT', which is parsed directly. Plain
+    numbers are treated as seconds from now. Anything else falls back to dateutil.
+
+    :param value: The 'expires_in' value.
+    :return: Epoch seconds as an int.
+    """
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.isdigit()):
+        return int(time.time()) + int(value)
+
+    try:
+        day, month, rest = value.split(', ', 1)[-1].split('-', 2)
+        year, clock, zone = rest.split(' ')
+        if zone not in ('GMT', 'UTC'):
+            raise ValueError("Unknown timezone: %s" % zone)
+        hour, minute, second = clock.split(':')
+        return calendar.timegm((int(year), MONTH_MAP[month.lower()], int(day), int(hour), int(minute), int(second)))
+    except (ValueError, KeyError, AttributeError):
+        pass
+
+    from dateutil import parser as duparser  # Only needed for unexpected formats.
+    expires = duparser.parse(value)
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return int(expires.timestamp())
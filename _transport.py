@@ -0,0 +1,227 @@
+"""
+HTTP transports used to talk with the NEST API.
+
+All NEST traffic goes through a transport object with a single `request()` method. The live transport
+uses treq. A recorder can wrap any transport and append every request/response pair to a log file, and a
+replay transport feeds those recordings back. This allows the poll loop and NEST_Thermostat.update_status
+to be exercised offline using real payloads. The request scheduler sits in front of all of them and sends
+device commands ahead of background polling.
+
+License
+=======
+
+Feel free to use or copy under the MIT license.
+
+The Yombo team and other contributors hopes that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:copyright: Copyright 2016 by Yombo.
+"""
+# Import python libraries
+try:  # Prefer simplejson if installed, otherwise json will work swell.
+    import simplejson as json
+except ImportError:
+    import json
+from collections import deque
+import time
+
+# Import twisted libraries
+from twisted.internet.defer import Deferred, inlineCallbacks, maybeDeferred, returnValue
+from twisted.internet.task import deferLater
+from twisted.internet import reactor
+
+from yombo.core.exceptions import YomboWarning
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.nest.transport")
+
+REDACTED = "**REDACTED**"
+REDACT_HEADERS = ('authorization',)
+REDACT_FIELDS = ('username', 'password', 'email', 'access_token')
+
+
+def redact(data):
+    """
+    Returns a copy of data with any credential fields replaced, at any depth within dictionaries and lists.
+    Other types are returned as is.
+
+    :param data: Request form data or a decoded response.
+    :return:
+    """
+    if isinstance(data, dict):
+        return {key: (REDACTED if key in REDACT_FIELDS else redact(value)) for key, value in data.items()}
+    if isinstance(data, list):
+        return [redact(value) for value in data]
+    return data
+
+
+class NestLiveTransport(object):
+    """
+    Sends requests to the NEST servers using treq.
+    """
+    @inlineCallbacks
+    def request(self, method, url, headers=None, data=None):
+        """
+        Send a request and collect the response.
+
+        :param method: Either 'get' or 'post'.
+        :param url: Full URL to request.
+        :param headers: Dictionary of headers to send.
+        :param data: Form data (dict) or a request body (str).
+        :return: A tuple of the response code and the raw content.
+        """
+        import treq  # Loaded on first request to keep gateway startup fast.
+        if method == 'post':
+            response = yield treq.post(url, data, headers=headers)
+        else:
+            response = yield treq.get(url, headers=headers)
+        content = yield treq.content(response)
+        returnValue((response.code, content))
+
+
+class NestTrafficRecorder(object):
+    """
+    Wraps another transport and appends every request/response pair to a log file, one compact JSON
+    document per line. Credentials are redacted before being written.
+    """
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.started = time.monotonic()
+        self.log_file = open(path, 'a')
+
+    @inlineCallbacks
+    def request(self, method, url, headers=None, data=None):
+        sent_at = time.monotonic()
+        code, content = yield self.transport.request(method, url, headers=headers, data=data)
+        self.write(method, url, headers, data, code, content, sent_at)
+        returnValue((code, content))
+
+    def write(self, method, url, headers, data, code, content, sent_at):
+        """
+        Append a single record to the log file.
+        """
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        try:
+            content = json.dumps(redact(json.loads(content)), separators=(',', ':'))
+        except ValueError:
+            pass
+
+        if headers is None:
+            headers = {}
+        record = {
+            'at': round(sent_at - self.started, 3),
+            'elapsed': round(time.monotonic() - sent_at, 3),
+            'method': method,
+            'url': url,
+            'headers': {key: (REDACTED if key.lower() in REDACT_HEADERS else value) for key, value in headers.items()},
+            'data': redact(data),
+            'code': code,
+            'content': content,
+        }
+        try:
+            self.log_file.write(json.dumps(record, separators=(',', ':')) + "\n")
+            self.log_file.flush()
+        except (IOError, OSError) as e:
+            logger.warn("NEST unable to write traffic capture '{path}': {e}", path=self.path, e=e)
+
+    def close(self):
+        self.log_file.close()
+
+
+class NestReplayTransport(object):
+    """
+    Returns responses from a log file created by NestTrafficRecorder instead of contacting NEST.
+
+    Responses are matched by method and URL and returned in the order they were recorded. Each response
+    is delayed by its original latency divided by `speed`; a speed of 0 returns responses immediately.
+    """
+    def __init__(self, path, speed=1.0, loop=True):
+        self.path = path
+        self.speed = float(speed)
+        self.loop = loop
+        self.records = {}
+        self.queues = {}
+
+        with open(path, 'r') as log_file:
+            for line in log_file:
+                line = line.strip()
+                if line == "":
+                    continue
+                record = json.loads(line)
+                key = (record['method'], record['url'])
+                if key not in self.records:
+                    self.records[key] = []
+                self.records[key].append(record)
+        for key, records in self.records.items():
+            self.queues[key] = deque(records)
+        logger.info("NEST replaying {count} recorded requests from: {path}",
+                    count=sum(len(records) for records in self.records.values()), path=path)
+
+    @inlineCallbacks
+    def request(self, method, url, headers=None, data=None):
+        key = (method, url)
+        if key not in self.queues:
+            raise YomboWarning("No recorded NEST response for: %s %s" % (method, url))
+        if len(self.queues[key]) == 0:
+            if self.loop is False:
+                raise YomboWarning("Recorded NEST responses exhausted for: %s %s" % (method, url))
+            self.queues[key].extend(self.records[key])
+
+        record = self.queues[key].popleft()
+        if self.speed > 0 and record['elapsed'] > 0:
+            yield deferLater(reactor, record['elapsed'] / self.speed, lambda: None)
+        returnValue((record['code'], record['content'].encode('utf-8')))
+
+
+LANE_COMMAND = 0  # Interactive device commands.
+LANE_CONFIRM = 1  # Reads confirming a command was applied.
+LANE_BACKGROUND = 2  # Periodic polls and device discovery.
+
+
+class NestRequestScheduler(object):
+    """
+    Wraps another transport and sends requests in priority order. Each lane has its own concurrency limit, so
+    background polling can never use the slots reserved for device commands.
+
+    :param transport: Transport to send the requests through.
+    :param limits: Dictionary of lane: max concurrent requests.
+    """
+    def __init__(self, transport, limits=None):
+        self.transport = transport
+        if limits is None:
+            limits = {LANE_COMMAND: 4, LANE_CONFIRM: 2, LANE_BACKGROUND: 2}
+        self.limits = limits
+        self.lanes = sorted(limits)
+        self.active = {lane: 0 for lane in self.lanes}
+        self.queues = {lane: deque() for lane in self.lanes}
+
+    def request(self, method, url, headers=None, data=None, lane=LANE_BACKGROUND):
+        """
+        Queue a request, it's sent as soon as its lane has a free slot.
+
+        :param lane: One of LANE_COMMAND, LANE_CONFIRM, LANE_BACKGROUND.
+        :return: A deferred that fires with the response code and raw content.
+        """
+        d = Deferred()
+        self.queues[lane].append((d, method, url, headers, data))
+        self.dispatch()
+        return d
+
+    def dispatch(self):
+        for lane in self.lanes:  # Lowest number is the highest priority.
+            queue = self.queues[lane]
+            while len(queue) and self.active[lane] < self.limits[lane]:
+                d, method, url, headers, data = queue.popleft()
+                self.active[lane] += 1
+                request = maybeDeferred(self.transport.request, method, url, headers=headers, data=data)
+                request.addBoth(self.request_done, lane)
+                request.chainDeferred(d)
+
+    def request_done(self, result, lane):
+        self.active[lane] -= 1
+        reactor.callLater(0, self.dispatch)
+        return result
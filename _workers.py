@@ -0,0 +1,148 @@
+"""
+Manages poll_worker.py processes. When enabled, NEST accounts are sharded by account hash across the workers.
+Each worker fetches and decodes the account data and only sends back the values that changed for each device.
+
+License
+=======
+
+Feel free to use or copy under the MIT license.
+
+The Yombo team and other contributors hopes that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:copyright: Copyright 2016 by Yombo.
+"""
+# Import python libraries
+try:  # Prefer simplejson if installed, otherwise json will work swell.
+    import simplejson as json
+except ImportError:
+    import json
+import os
+import sys
+
+# Import twisted libraries
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet import reactor
+
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.nest.workers")
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poll_worker.py')
+
+
+class NestPollWorkerProtocol(ProcessProtocol):
+    """
+    Talks to a single worker process using one JSON document per line.
+    """
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+        self.buffer = b""
+
+    def send(self, message):
+        self.transport.write(json.dumps(message, separators=(',', ':')).encode() + b"\n")
+
+    def outReceived(self, data):
+        self.buffer += data
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            if line == b"":
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                logger.warn("NEST poll worker {index} sent invalid data.", index=self.index)
+                continue
+            self.manager.worker_message(message)
+
+    def errReceived(self, data):
+        logger.warn("NEST poll worker {index}: {data}", index=self.index, data=data.decode('utf-8', 'replace'))
+
+    def processEnded(self, reason):
+        self.manager.worker_ended(self.index)
+
+
+class NestPollWorkers(object):
+    """
+    Starts the worker processes and routes poll requests to them.
+
+    :param count: Number of worker processes.
+    :param apply_delta: Called with account_hash, serial, and delta for every device update received.
+    :param account_done: Called with account_hash and success (bool) once a worker has finished polling an
+        account.
+    """
+    def __init__(self, count, apply_delta, account_done=None):
+        self.count = count
+        self.apply_delta = apply_delta
+        self.account_done = account_done
+        self.workers = [None] * count
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index in range(self.count):
+            self.spawn(index)
+
+    def stop(self):
+        self.running = False
+        for worker in self.workers:
+            if worker is not None:
+                worker.transport.closeStdin()
+
+    def spawn(self, index):
+        protocol = NestPollWorkerProtocol(self, index)
+        reactor.spawnProcess(protocol, sys.executable, [sys.executable, WORKER_SCRIPT], env=os.environ)
+        self.workers[index] = protocol
+
+    def shard(self, account_hash):
+        """
+        Returns the index of the worker responsible for an account.
+        """
+        return int(account_hash[:8], 16) % self.count
+
+    def poll(self, account_hash, username, password, serials, resync=None):
+        """
+        Ask the worker responsible for this account to poll it.
+
+        :param account_hash: Hash of the username and password, used to pick the worker.
+        :param serials: List of NEST serials to report on.
+        :param resync: List of serials to send in full, instead of only what changed.
+        :return:
+        """
+        worker = self.workers[self.shard(account_hash)]
+        if worker is None:
+            logger.warn("NEST poll worker for account isn't running, skipping this poll.")
+            return
+        worker.send({
+            'account': account_hash,
+            'username': username,
+            'password': password,
+            'serials': serials,
+            'resync': resync if resync is not None else [],
+        })
+
+    def worker_message(self, message):
+        # Never let an exception reach the process reader, it would drop the worker's pipe.
+        try:
+            if 'error' in message:
+                logger.warn("NEST poll worker had a problem: {error}", error=message['error'])
+            elif 'delta' in message:
+                self.apply_delta(message['account'], message['serial'], message['delta'])
+            elif 'done' in message and self.account_done is not None:
+                self.account_done(message['account'], message.get('success', True))
+        except Exception as e:
+            logger.error("NEST unable to process poll worker message: {e}", e=e)
+
+    def worker_ended(self, index):
+        self.workers[index] = None
+        if self.running:
+            logger.warn("NEST poll worker {index} stopped, restarting in 10 seconds.", index=index)
+            reactor.callLater(10, self.restart, index)
+
+    def restart(self, index):
+        if self.running and self.workers[index] is None:
+            self.spawn(index)
@@ -14,19 +14,18 @@ or FITNESS FOR A PARTICULAR PURPOSE.
 :copyright: Copyright 2016 by Yombo.
 """
 # Import python libraries
+import time
+_import_started = time.monotonic()
 try:  # Prefer simplejson if installed, otherwise json will work swell.
     import simplejson as json
 except ImportError:
     import json
 from hashlib import sha256
-from dateutil import parser as duparser
-import time
-import traceback
-import treq
 
 # Import twisted libraries
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
 from twisted.internet import reactor
 
 from yombo.core.exceptions import YomboWarning
@@ -36,10 +35,15 @@ from yombo.lib.webinterface.auth import require_auth
 from yombo.utils import unit_converters
 from yombo.utils.maxdict import MaxDict
 
+from ._history import History
+from ._timeutils import parse_expires_in
+from ._transport import NestLiveTransport, NestTrafficRecorder, NestReplayTransport, NestRequestScheduler, \
+    LANE_COMMAND, LANE_CONFIRM, LANE_BACKGROUND
+from ._workers import NestPollWorkers
+
 logger = get_logger("modules.nest")
 
-import sys
-from optparse import OptionParser
+_import_finished = time.monotonic()
 
 AWAY_MAP = {
     'on': True,
@@ -63,34 +67,213 @@ FAN_MAP = {
     False: 'auto'
 }
 
+_fast_json_loads = None  # Resolved on first decode, see timed_json_loads().
+
+def timed_json_loads(content):
+    """
+    Decode JSON with the fastest decoder available, and return how long it took. Used within a thread.
+
+    :param content: Raw JSON content.
+    :return: A tuple of the decoded content and seconds taken.
+    """
+    global _fast_json_loads
+    if _fast_json_loads is None:
+        try:  # orjson is much faster for large payloads, use it for big NEST accounts if installed.
+            from orjson import loads as _fast_json_loads
+        except ImportError:
+            _fast_json_loads = json.loads
+    started = time.monotonic()
+    content = _fast_json_loads(content)
+    return content, time.monotonic() - started
+
 class Nest(YomboModule):
     """
     Provides support for nest. Periodically gets the status of the HVAC system.
     """
-    @inlineCallbacks
     def _init_(self, **kwargs):
+        # Other modules load between our import and _init_, track that separately.
+        self.startup_phases = [('module_load', _import_started), ('imports', _import_finished),
+                               ('waiting_for_init', time.monotonic())]
         self.devices = {}
         self.temperature_display = self._Configs.get2('misc', 'temperature_display', 'f')
         self.pending_requests = MaxDict(200)  # track pending requests here.
 
-        self.nest_transport = None
+        self.nest_transport = self.setup_transport()
+        self.nest_scheduler = NestRequestScheduler(self.nest_transport, {
+            LANE_COMMAND: int(self._Configs.get('nest', 'command_concurrency', 4, False)),
+            LANE_CONFIRM: int(self._Configs.get('nest', 'confirm_concurrency', 2, False)),
+            LANE_BACKGROUND: int(self._Configs.get('nest', 'background_concurrency', 2, False)),
+        })
         self.nest_access_token = None
 
         self.nest_login_url = "https://home.nest.com/user/login"
         self.nest_user_agent = "Nest/2.1.3 CFNetwork/548.0.4"
         self.nest_protocol_version = "1"
+        # Responses larger than this (bytes) are decoded in a thread so the reactor isn't stalled.
+        self.decode_thread_size = int(self._Configs.get('nest', 'decode_thread_size', 65536, False))
+        self.decode_metrics = {
+            'inline_count': 0,
+            'inline_seconds': 0.0,  # Time the reactor was stalled decoding.
+            'inline_max_seconds': 0.0,
+            'thread_count': 0,
+            'thread_seconds': 0.0,  # Time spent decoding that was moved off the reactor.
+            'thread_max_seconds': 0.0,
+        }
 
         self.nest_device_type = self._DeviceTypes['nest_thermostat']
-        self.nest_accounts = yield self._SQLDict.get(self, "nestaccounts")  # store transports and access tokens here.
+        self.periodic_poll_thermostat_loop = None
+        self.start_polling_retry = None  # IDelayedCall to check for devices again.
+        self.nest_device_states = {}  # serial: merged data received from poll workers.
+        self.nest_stale_serials = set()  # serials that failed to update, the workers resend them in full.
+        self.nest_updated_serials = set()  # serials updated by a poll worker delta since their account was done.
+        self.structure_history = {}  # structure_id: History, averaged across the structure's thermostats.
+        self.nest_account_serials = {}  # account_hash: serials polled by the workers for that account.
+        self.poll_workers = None
+        poll_worker_count = int(self._Configs.get('nest', 'poll_workers', 0, False))
+        if poll_worker_count > 0:
+            if isinstance(self.nest_transport, NestLiveTransport):
+                self.poll_workers = NestPollWorkers(poll_worker_count, self.apply_poll_delta,
+                                                    self.worker_account_done)
+            else:
+                logger.warn("NEST poll workers are disabled while capturing or replaying traffic.")
+
+        # Don't block loading on the account store, nest_account() waits for it if needed.
+        self.nest_accounts = None  # store transports and access tokens here.
+        self.nest_account_deadlines = {}  # account_hash: time.monotonic() value when the token should be renewed.
+        self.nest_accounts_loaded = self._SQLDict.get(self, "nestaccounts")
+        self.nest_accounts_loaded.addCallbacks(self.nest_accounts_hydrated, self.nest_accounts_failed)
+        self.startup_phase('init')
+
+    def nest_accounts_hydrated(self, accounts):
+        self.nest_accounts = accounts
+        self.startup_phase('accounts_loaded')
+        return accounts
+
+    def nest_accounts_failed(self, failure):
+        """
+        The account store couldn't be loaded. Continue with an empty one, it only caches logins.
+        """
+        logger.warn("NEST unable to load saved accounts, logging in again as needed: {error}",
+                    error=failure.getErrorMessage())
+        return self.nest_accounts_hydrated({})
+
+    def startup_phase(self, name):
+        """
+        Mark the end of a startup phase. Use startup_report() to see how long each phase took.
+
+        :param name: Label for the phase that just completed.
+        :return:
+        """
+        self.startup_phases.append((name, time.monotonic()))
+
+    def startup_report(self):
+        """
+        Returns a list of tuples containing the phase name and how long it took, in milliseconds.
+
+        :return:
+        """
+        report = []
+        for i in range(1, len(self.startup_phases)):
+            name, finished = self.startup_phases[i]
+            report.append((name, round((finished - self.startup_phases[i-1][1]) * 1000, 2)))
+        return report
+
+    def _unload_(self, **kwargs):
+        if self.periodic_poll_thermostat_loop is not None and self.periodic_poll_thermostat_loop.running:
+            self.periodic_poll_thermostat_loop.stop()
+        if self.start_polling_retry is not None and self.start_polling_retry.active():
+            self.start_polling_retry.cancel()
+        if self.poll_workers is not None:
+            self.poll_workers.stop()
+        if isinstance(self.nest_transport, NestTrafficRecorder):
+            self.nest_transport.close()
+
+    def setup_transport(self):
+        """
+        Select how to talk with NEST. Normally requests go to the NEST servers. Setting 'nest.replay_file'
+        feeds back previously recorded traffic instead, at 'nest.replay_speed' times the original speed (0 for
+        no delay). Setting 'nest.capture_file' records all traffic, with credentials redacted, to the file.
+
+        :return:
+        """
+        replay_file = self._Configs.get('nest', 'replay_file', '', False)
+        capture_file = self._Configs.get('nest', 'capture_file', '', False)
+
+        self.replay_speed = None  # Only set while replaying.
+        if replay_file:
+            self.replay_speed = float(self._Configs.get('nest', 'replay_speed', 1.0, False))
+            transport = NestReplayTransport(replay_file, self.replay_speed)
+        else:
+            transport = NestLiveTransport()
+        if capture_file:
+            logger.info("NEST capturing traffic to: {path}", path=capture_file)
+            transport = NestTrafficRecorder(transport, capture_file)
+        return transport
 
     def _start_(self, **kwargs):
         """
-        Sets up a period call to get nest thermostat status.
+        Sets up a period call to get nest thermostat status. Polling only starts once the account store has
+        been loaded and at least one NEST device exists.
 
         :return:
         """
+        self.startup_phase('start')
+        self.nest_accounts_loaded.addCallback(self.nest_accounts_start_polling)
+
+    def nest_accounts_start_polling(self, accounts):
+        self.start_polling()
+        return accounts  # Others may still be waiting on this deferred for the accounts.
+
+    def register_device(self, device):
+        """
+        Track a NEST device so it's included when polling. Starts polling if this is the first device.
+
+        :param device: A NEST_Thermostat device.
+        :return:
+        """
+        if device.device_id in self.devices:
+            return
+        self.devices[device.device_id] = device
+        if self.periodic_poll_thermostat_loop is None and self.nest_accounts is not None:
+            self.start_polling()
+
+    def start_polling(self):
+        """
+        Start the periodic poll loop. If no NEST devices exist yet, check again later.
+
+        :return:
+        """
+        if self.periodic_poll_thermostat_loop is not None:
+            return
+        for device_id, device in self.nest_device_type.get_devices().items():
+            self.devices[device_id] = device
+        if len(self.devices) == 0:
+            if self.start_polling_retry is None or self.start_polling_retry.active() is False:
+                self.start_polling_retry = reactor.callLater(30, self.start_polling)
+            return
+        if self.start_polling_retry is not None and self.start_polling_retry.active():
+            self.start_polling_retry.cancel()
+
+        self.startup_phase('devices_registered')
+        if self.poll_workers is not None:
+            self.poll_workers.start()
         self.periodic_poll_thermostat_loop = LoopingCall(self.periodic_poll_thermostat)
-        self.periodic_poll_thermostat_loop.start(300)
+        self.periodic_poll_thermostat_loop.start(self.poll_interval())
+        logger.debug("NEST startup timing (ms): {report}",
+                     report=", ".join("%s: %s" % phase for phase in self.startup_report()))
+
+    def poll_interval(self):
+        """
+        Seconds between polls. When replaying traffic, this is sped up by 'nest.replay_speed' so a captured
+        sequence replays in a fraction of the time. A speed of 0 polls once a second.
+
+        :return:
+        """
+        if self.replay_speed is None:
+            return 300
+        if self.replay_speed <= 0:
+            return 1
+        return 300 / self.replay_speed
 
     def _configuration_set_(self, **kwargs):
         """
@@ -241,6 +424,22 @@ class Nest(YomboModule):
                                         nest_device_type=self.nest_device_type
                                         ))
 
+            @webapp.route("/tools/module_nest/history", methods=['GET'])
+            @require_auth()
+            def page_tools_module_nest_history_get(webinterface, request, session):
+                request.setHeader('Content-Type', 'application/json')
+                try:
+                    window = int(request.args.get('window', ['3600'])[0])
+                    device_id = request.args.get('device_id', [None])[0]
+                    structure_id = request.args.get('structure_id', [None])[0]
+                    metrics = request.args.get('metric', ['temperature', 'humidity', 'target_temp', 'running'])
+                    results = {metric: self.history_aggregate(metric, window, device_id, structure_id)
+                               for metric in metrics}
+                except (ValueError, KeyError, YomboWarning) as e:
+                    request.setResponseCode(400)
+                    return json.dumps({'status': 'failed', 'msg': str(e)})
+                return json.dumps({'status': 'success', 'window': window, 'history': results})
+
     def clean_session_data(self, session):
         """
         Remove any items stored in the session.
@@ -301,99 +500,285 @@ class Nest(YomboModule):
     @inlineCallbacks
     def periodic_poll_thermostat(self):
         """
-        Periodically asks the NEST api for curent status of the device.
+        Periodically asks the NEST api for curent status of the device. If poll workers are enabled, the
+        requests are handed off to them and results arrive through apply_poll_delta().
 
         :return:
         """
-        for device_id, device in self.devices.items():
-            data = yield self.poll_thermostat(device_id)
-            self.save_status(device_id, data)
+        if self.poll_workers is not None:
+            self.poll_thermostats_with_workers()
+            return
+        for device_id, device in list(self.devices.items()):
+            # Errors must not escape, they would stop the LoopingCall for good.
+            try:
+                yield self.poll_thermostat(device_id)
+            except Exception as e:
+                logger.warn("NEST unable to poll device {label}: {e}", label=device.label, e=e)
+        self.add_structure_history()
+        metrics = self.get_decode_metrics()
+        logger.debug("NEST JSON decoding - inline (stalls the reactor): {inline_count} decodes, "
+                     "{inline_seconds:.4f}s total, {inline_max_seconds:.4f}s max; "
+                     "thread (off the reactor): {thread_count} decodes, {thread_seconds:.4f}s total, "
+                     "{thread_max_seconds:.4f}s max",
+                     **metrics)
+
+    def poll_thermostats_with_workers(self):
+        """
+        Group devices by NEST account and send one request per account to the responsible worker.
+
+        :return:
+        """
+        accounts = {}
+        for device_id, yombo_device in self.devices.items():
+            device_variables = yombo_device.device_variables_cached
+            username = device_variables['username']['values'][0]
+            password = device_variables['password']['values'][0]
+            account_hash = self.account_hash(username, password)
+            if account_hash not in accounts:
+                accounts[account_hash] = {'username': username, 'password': password, 'serials': []}
+            serial = device_variables['serial']['values'][0]
+            accounts[account_hash]['serials'].append(serial)
+            self.nest_account_serials[account_hash] = accounts[account_hash]['serials']
+            if serial not in self.nest_device_states:
+                self.nest_device_states[serial] = {'yombo_device': yombo_device, 'data': {}}
+
+        for account_hash, account in accounts.items():
+            resync = [serial for serial in account['serials'] if serial in self.nest_stale_serials]
+            self.poll_workers.poll(account_hash, account['username'], account['password'], account['serials'],
+                                   resync)
+            self.nest_stale_serials.difference_update(resync)
+
+    def apply_poll_delta(self, account_hash, serial, delta):
+        """
+        Merge changed values from a poll worker into the device data and update the device.
+
+        :param account_hash:
+        :param serial: NEST serial the changes are for.
+        :param delta: Dictionary of sections ('shared', 'device', 'structure'), containing only changed values.
+        :return:
+        """
+        if serial not in self.nest_device_states:
+            return
+        data = self.nest_device_states[serial]['data']
+        try:
+            for section, values in delta.items():
+                if section not in data:
+                    data[section] = {}
+                data[section].update(values)
+            self.nest_device_states[serial]['yombo_device'].device = data
+            self.nest_updated_serials.add(serial)
+        except Exception as e:
+            logger.warn("NEST unable to update device with serial {serial}: {e}", serial=serial, e=e)
+            # Start over with a full snapshot on the next poll.
+            self.nest_device_states[serial]['data'] = {}
+            self.nest_stale_serials.add(serial)
+
+    def worker_account_done(self, account_hash, success=True):
+        """
+        Called when a poll worker has sent all changes for an account. Workers don't send anything for
+        thermostats that didn't change, so those get a history sample with their last values here. This keeps
+        one sample per poll cycle for every thermostat. Then one structure history sample is recorded for each
+        of the account's structures.
+
+        :param account_hash:
+        :param success: False if the worker was unable to poll the account.
+        :return:
+        """
+        structure_ids = set()
+        for serial in self.nest_account_serials.get(account_hash, []):
+            updated = serial in self.nest_updated_serials
+            self.nest_updated_serials.discard(serial)
+            if serial not in self.nest_device_states or 'structure' not in self.nest_device_states[serial]['data']:
+                continue
+            if success is False or serial in self.nest_stale_serials:
+                continue
+            if updated is False:
+                history = self.nest_device_states[serial]['yombo_device'].history
+                history.add(dict(history.latest))
+            structure_ids.add(self.nest_device_states[serial]['data']['structure'].get('structure_id'))
+        if len(structure_ids):
+            self.add_structure_history(structure_ids)
 
     @inlineCallbacks
-    def poll_thermostat(self, device_id):
-        yombo_device = self.devices['device_id']
+    def poll_thermostat(self, device_id, lane=LANE_BACKGROUND):
+        yombo_device = self.devices[device_id]
         device_variables = yombo_device.device_variables_cached
 
-        nest_account = yield self.nest_account(device_variables['username']['values'][0], device_variables['password']['values'][0])
-        device = yield self.nest_api_request(nest_account, "get", "/v2/mobile/user." + nest_account['userid'])
+        nest_account = yield self.nest_account(device_variables['username']['values'][0],
+                                               device_variables['password']['values'][0], lane=lane)
+        device = yield self.nest_api_request(nest_account, "get", "/v2/mobile/user." + nest_account['userid'],
+                                             lane=lane)
 
         device_serial = device_variables['serial']['values'][0]
         # we have to map the nest serial to the structure, to get the correct structure information.
-        structure_id = device['link'][device_serial]['structure'].split('.')[0]  # structure.xxxxxx...
+        structure_id = device['link'][device_serial]['structure'].split('.')[-1]  # structure.xxxxxx...
 
         data = {
             'shared': device['shared'][device_serial],
-            'device': device['devices'][device_serial],
-            'structure': device['structure'][structure_id],
+            'device': device['device'][device_serial],
+            'structure': dict(device['structure'][structure_id], structure_id=structure_id),
         }
-        yombo_device.device = data
-        yombo_device.update_status()
+        yombo_device.device = data  # Setting the data also updates the status.
+
+    def add_structure_history(self, structure_ids=None):
+        """
+        Record one structure history sample, the average of the latest values from its thermostats. Called
+        once all thermostats have been polled, so each structure gets a single sample per poll cycle.
+
+        :param structure_ids: Iterable of NEST structure ids, defaults to all known structures.
+        :return:
+        """
+        totals = {}  # structure_id: {metric: [values]}
+        for device_id, yombo_device in self.devices.items():
+            if yombo_device.device is None or 'structure' not in yombo_device.device:
+                continue
+            structure_id = yombo_device.device['structure'].get('structure_id')
+            if structure_id is None or (structure_ids is not None and structure_id not in structure_ids):
+                continue
+            if structure_id not in totals:
+                totals[structure_id] = {}
+            for metric, value in yombo_device.history.latest.items():
+                if metric not in totals[structure_id]:
+                    totals[structure_id][metric] = []
+                totals[structure_id][metric].append(value)
+
+        for structure_id, metrics in totals.items():
+            if len(metrics) == 0:
+                continue
+            if structure_id not in self.structure_history:
+                self.structure_history[structure_id] = History()
+            self.structure_history[structure_id].add({metric: sum(values) / len(values) for metric, values in metrics.items()})
+
+    def history_aggregate(self, metric, window, device_id=None, structure_id=None):
+        """
+        Get min, max, mean, first, last and slope (per hour) for a metric over the last `window` seconds,
+        using history kept in memory. Either a device_id or a structure_id must be provided.
+
+        :param metric: One of: temperature, humidity, target_temp, running (mean is the fraction of time running)
+        :param window: Seconds to look back.
+        :param device_id: Yombo device id of a NEST thermostat.
+        :param structure_id: NEST structure id.
+        :return: Dictionary, or None if there is no history for the window.
+        """
+        if device_id is not None:
+            if device_id not in self.devices:
+                raise YomboWarning("NEST device not found: %s" % device_id)
+            return self.devices[device_id].history_aggregate(metric, window)
+        if structure_id is not None:
+            if structure_id not in self.structure_history:
+                raise YomboWarning("NEST structure not found: %s" % structure_id)
+            return self.structure_history[structure_id].aggregate(metric, window)
+        raise YomboWarning("NEST history requires a device_id or structure_id.")
 
     @inlineCallbacks
-    def nest_account(self, username, password, force_login=None):
-        account_hash = sha256(str(username+password).encode()).hexdigest()
-        if account_hash in self.nest_accounts and force_login is not True:
-            if self.nest_accounts[account_hash]['expires_in_epoch'] > int(time.time()) + 300:
+    def nest_account(self, username, password, force_login=None, lane=LANE_BACKGROUND):
+        if self.nest_accounts is None:
+            yield self.nest_accounts_loaded
+        account_hash = self.account_hash(username, password)
+        if force_login is not True:
+            if self.nest_account_deadlines.get(account_hash, 0) > time.monotonic():
                 returnValue(self.nest_accounts[account_hash])
-            else:
+            if account_hash in self.nest_accounts:
+                # Loaded from the account store, convert the saved wall clock expiration once.
+                deadline = self.nest_account_deadline(self.nest_accounts[account_hash]['expires_in_epoch'])
+                if deadline > time.monotonic():
+                    self.nest_account_deadlines[account_hash] = deadline
+                    returnValue(self.nest_accounts[account_hash])
                 del self.nest_accounts[account_hash]
+        self.nest_account_deadlines.pop(account_hash, None)
 
-        response = yield treq.post("https://home.nest.com/user/login",
-                                   {"username": username, "password": password},
-                                   headers={"user-agent": self.nest_user_agent}
-                                   )
-
-        content = yield treq.content(response)
+        code, content = yield self.nest_scheduler.request('post', self.nest_login_url,
+                                                          headers={"user-agent": self.nest_user_agent},
+                                                          data={"username": username, "password": password},
+                                                          lane=lane,
+                                                          )
         content = json.loads(content)  # convert from json to dictionary
         if 'error' in content:
             raise YomboWarning("Error with NEST Account: %s" % content['error_description'])
 
-        content['expires_in_epoch'] = int(duparser.parse(content['expires_in']).strftime('%s'))
+        content['expires_in_epoch'] = parse_expires_in(content['expires_in'])
+        self.nest_account_deadlines[account_hash] = self.nest_account_deadline(content['expires_in_epoch'])
         self.nest_accounts[account_hash] = content
         returnValue(content)
         # transport = content['urls']['transport_url']
         # access_token = content['access_token']
         # userid = content['userid']
 
+    def account_hash(self, username, password):
+        return sha256(str(username+password).encode()).hexdigest()
+
+    def nest_account_deadline(self, expires_in_epoch):
+        """
+        Convert a token expiration (epoch seconds) into a time.monotonic() deadline, leaving 5 minutes to
+        renew. This way, wall clock changes don't cause extra logins.
+
+        When replaying traffic, recorded tokens have usually expired already. They are treated as valid for the
+        whole replay so that no extra logins are made and the replayed load matches the capture.
+
+        :param expires_in_epoch:
+        :return:
+        """
+        if self.replay_speed is not None:
+            return float('inf')
+        return time.monotonic() + (expires_in_epoch - time.time()) - 300
+
     @inlineCallbacks
-    def nest_api_request(self, nest_account, method, url, data=None, additional_headers=None):
-        print("nest account: %s" % nest_account)
-        print("method: %s" % method)
-        print("data: %s" % data)
+    def nest_api_request(self, nest_account, method, url, data=None, additional_headers=None, lane=LANE_BACKGROUND):
         request_url = nest_account['urls']['transport_url'] + url
-        print("request_url: %s" % request_url)
         headers = {
             "user-agent": self.nest_user_agent,
             "X-nl-protocol-version": self.nest_protocol_version
         }
-        print("bbb3")
         if 'access_token' in nest_account:
             headers["Authorization"] = "Basic " + nest_account['access_token']
         if 'userid' in nest_account:
             headers["X-nl-user-id"] = nest_account['userid']
-        print("headers: %s" % headers)
 
         if isinstance(additional_headers, dict):
             headers.update(additional_headers)
 
-        print("bbb 10")
-
-        if method == 'get':
-            response = yield treq.get(request_url, headers=headers)
         if method == 'post':
-            print("data: %s" % json.dumps(data))
-            response = yield treq.post(request_url, headers=headers,  data=json.dumps(data))
-
-        print("bbb 15 response code: %s" % response.code)
+            data = json.dumps(data)
+        logger.debug("NEST request: {method} {url}", method=method, url=url)
+        code, content = yield self.nest_scheduler.request(method, request_url, headers=headers, data=data, lane=lane)
+        logger.debug("NEST response code: {code}", code=code)
 
-        content = yield treq.content(response)
-        print("about to decode json... '%s'" % content)
-        content = json.loads(content)  # convert from json to dictionary
-        print("about to decode json...done")
+        content = yield self.decode_response(content)
         if 'error' in content:
             raise YomboWarning("Error with NEST Request: %s" % content['error_description'])
         returnValue(content)
 
+    def get_decode_metrics(self):
+        """
+        Returns how many responses were decoded inline (on the reactor) and in a thread, with the total and
+        max seconds spent for each. Thread time is time that no longer stalls the reactor.
+
+        :return: A copy of the metrics dictionary.
+        """
+        return dict(self.decode_metrics)
+
+    @inlineCallbacks
+    def decode_response(self, content):
+        """
+        Convert a JSON response to a dictionary. Large responses are decoded in a thread, small ones inline.
+        Time taken is tracked in self.decode_metrics.
+
+        :param content: Raw JSON content.
+        :return:
+        """
+        if len(content) > self.decode_thread_size:
+            content, elapsed = yield deferToThread(timed_json_loads, content)
+            lane = 'thread'
+        else:
+            content, elapsed = timed_json_loads(content)
+            lane = 'inline'
+
+        self.decode_metrics[lane + '_count'] += 1
+        self.decode_metrics[lane + '_seconds'] += elapsed
+        if elapsed > self.decode_metrics[lane + '_max_seconds']:
+            self.decode_metrics[lane + '_max_seconds'] = elapsed
+        returnValue(content)
+
     def device_command_send_pending(self, request_id):
         self.pending_requests[request_id]['device'].device_command_pending(request_id)
         self.pending_requests[request_id]['nest_pending_callback'] = \
@@ -423,6 +808,7 @@ class Nest(YomboModule):
                 logger.debug("NEST module cannot handle device_type_id: {device_type_id}", device_type_id=device.device_type_id)
                 return None
 
+            self.register_device(device)
             request_id = kwargs['request_id']
 
             command = kwargs['command']
@@ -443,17 +829,21 @@ class Nest(YomboModule):
                     logger.warn("NEST Requires 'target_temp' in kwargs of do_command request.")
                     self.device_command_cancel(request_id)
                 else:
-                    results = yield self.set_temp(device.device_id, kwargs['target_temp'], request_id)
+                    results = yield self.set_temp(device, kwargs['target_temp'], request_id)
             else:
                 logger.warn("NEST received unknown command: {command}", command=command.machine_label)
                 self.device_command_cancel(request_id)
 
             if self.pending_requests[request_id]['nest_running'] is True:
-                status = yield self.get_thermostat_status(device.device_id)
+                try:
+                    yield self.poll_thermostat(device.device_id, lane=LANE_CONFIRM)
+                except YomboWarning:
+                    status = False
+                else:
+                    status = True
 
             if self.pending_requests[request_id]['nest_running'] is True:
                 if status is not False:
-                    self.save_status(device.device_id, status)
                     device.command_done(request_id)
                 else:
                     device.command_failed(request_id, message=_('module.nest', "NEST timed out, check network connection."))
@@ -462,41 +852,49 @@ class Nest(YomboModule):
                 self.pending_requests[request_id]['nest_pending_callback'].cancel()
             del self.pending_requests[request_id]
         except Exception as e:
-            print("eeeeeeeeeeeeeeeeeeeeeeeeeeee %s" % e)
+            import traceback
             logger.error("---------------==(Traceback)==--------------------------")
             logger.error("{trace}", trace=traceback.format_exc())
             logger.error("--------------------------------------------------------")
             logger.warn("Had trouble processing device_command: {e}", e=e)
 
     @inlineCallbacks
-    def api_post(self, device_id, type, data):
-        transport = self.devices[device_id]['transport']
-        serial = self.devices[device_id]['nest_serial']
-        userid = self.devices[device_id]['userid']
-        access_token = self.devices[device_id]['access_token']
-
-        response = yield treq.get(transport + "/v2/mobile/" + type + "." + serial,
-                            data,
-                            headers={"user-agent":"Nest/1.1.0.10 CFNetwork/548.0.4",
-                                       "Authorization":"Basic " + access_token,
-                                       "X-nl-protocol-version": "1"})
-        content = yield treq.content(response)
-        content = json.loads(content)  # convert from json to dictionary
-        returnValue(content)
+    def nest_put(self, device, bucket, data):
+        """
+        Send a change for a thermostat to NEST using the command lane, ahead of any background polling.
+
+        :param device: The NEST_Thermostat device.
+        :param bucket: NEST bucket to change, either 'shared' or 'device'.
+        :param data: Dictionary of values to change.
+        :return: The NEST response.
+        """
+        device_variables = device.device_variables_cached
+        nest_account = yield self.nest_account(device_variables['username']['values'][0],
+                                               device_variables['password']['values'][0], lane=LANE_COMMAND)
+        response = yield self.nest_api_request(nest_account, "post",
+                                               "/v2/put/%s.%s" % (bucket, device_variables['serial']['values'][0]),
+                                               data, lane=LANE_COMMAND)
+        returnValue(response)
 
     @inlineCallbacks
-    def set_temp(self, device_id, temp):
-        if (self.temp_display == "f"):  # nest always talks in c, so we convert any inputs if system is set to f.
-            temp = unit_converters['f_c'](temp)
+    def set_temp(self, device, temp, request_id):
+        if self.temperature_display() == "f":  # nest always talks in c, so we convert any inputs if system is set to f.
+            temp = unit_converters['f_c'](float(temp))
 
-        request_data = '{"target_change_pending":true,"target_temperature":' + '%0.1f' % temp + '}'
-        response = yield self.api_post(device_id, 'shared')
+        data = {
+            "target_change_pending": True,
+            "target_temperature": round(float(temp), 1),
+        }
+        response = yield self.nest_put(device, 'shared', data)
+        returnValue(response)
 
     @inlineCallbacks
-    def set_fan(self, device_id, state):
-
-        request_data = '{"fan_mode":"' + str(state) + '"}'
-        response = yield self.api_post(device_id, 'device', request_data)
+    def set_fan(self, device, state, request_id=None):
+        data = {
+            "fan_mode": FAN_MAP[state],
+        }
+        response = yield self.nest_put(device, 'device', data)  # fan_mode is kept in the device bucket.
+        returnValue(response)
 
     @inlineCallbacks
     def set_mode(self, device, command, request_id):
@@ -504,15 +902,6 @@ class Nest(YomboModule):
             "target_change_pending": True,
             'target_temperature_type': command.machine_label.lower()
         }
-        print("aaaa")
-        device_variables = device.device_variables_cached
-        print("aaaa 1")
-        nest_account = yield self.nest_account(device_variables['username']['values'][0], device_variables['password']['values'][0])
-        print("aaaa 2")
-        response = yield self.nest_api_request(nest_account, "post", "/v2/put/shared." + device_variables['serial']['values'][0], data)
-        print("aaaa 3")
-
-        print("nest set_mode respinse: %s" % response)
-        # request_data = '{"target_temperature_type":"' + str(state) + '"}'
-        # response = yield self.api_post(device.device_id, 'shared', request_data)
-
+        response = yield self.nest_put(device, 'shared', data)
+        logger.debug("NEST set_mode response: {response}", response=response)
+        returnValue(response)
@@ -0,0 +1,169 @@
+#! /usr/bin/python
+"""
+Polls NEST accounts on behalf of the NEST module, which starts one or more of these as separate processes.
+
+Requests are read from stdin, one JSON document per line:
+  {"account": "<hash>", "username": "...", "password": "...", "serials": ["..."], "resync": ["..."]}
+
+Serials listed in "resync" are sent in full instead of only what changed.
+
+For every serial, only the values that changed since the previous poll are written to stdout:
+  {"account": "<hash>", "serial": "...", "delta": {"shared": {...}, "device": {...}, "structure": {...}}}
+
+When an account is done, {"account": "<hash>", "done": true, "success": true} is sent. Problems are
+returned as {"account": "<hash>", "error": "..."}, followed by a done message with "success": false.
+
+License
+=======
+
+Feel free to use or copy under the MIT license.
+
+The Yombo team and other contributors hopes that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:copyright: Copyright 2016 by Yombo.
+"""
+# Import python libraries
+try:  # Prefer simplejson if installed, otherwise json will work swell.
+    import simplejson as json
+except ImportError:
+    import json
+import time
+import treq
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor, stdio
+from twisted.protocols.basic import LineReceiver
+
+from _timeutils import parse_expires_in  # This script's directory is first on the path.
+
+NEST_LOGIN_URL = "https://home.nest.com/user/login"
+NEST_USER_AGENT = "Nest/2.1.3 CFNetwork/548.0.4"
+NEST_PROTOCOL_VERSION = "1"
+
+
+class PollWorker(LineReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = 1048576
+
+    def __init__(self):
+        self.accounts = {}  # account hash: login response
+        self.deadlines = {}  # account hash: time.monotonic() value when the token should be renewed.
+        self.last_sent = {}  # serial: {section: values} as last sent to the gateway.
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return
+        self.poll_account(request)
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+    def send(self, message):
+        self.transport.write(json.dumps(message, separators=(',', ':')).encode() + b"\n")
+
+    @inlineCallbacks
+    def login(self, request, force_login=False):
+        account_hash = request['account']
+        if force_login is False and self.deadlines.get(account_hash, 0) > time.monotonic():
+            returnValue(self.accounts[account_hash])
+        self.accounts.pop(account_hash, None)
+        self.deadlines.pop(account_hash, None)
+
+        response = yield treq.post(NEST_LOGIN_URL,
+                                   {"username": request['username'], "password": request['password']},
+                                   headers={"user-agent": NEST_USER_AGENT}
+                                   )
+        content = yield treq.content(response)
+        content = json.loads(content)
+        if 'error' in content:
+            raise Exception("Error with NEST Account: %s" % content['error_description'])
+        expires_in_epoch = parse_expires_in(content['expires_in'])
+        # Same as the module: a monotonic deadline, leaving 5 minutes to renew.
+        self.deadlines[account_hash] = time.monotonic() + (expires_in_epoch - time.time()) - 300
+        self.accounts[account_hash] = content
+        returnValue(content)
+
+    @inlineCallbacks
+    def fetch(self, nest_account):
+        """
+        Returns the response code and raw content. The content isn't decoded here, an expired token may
+        not return JSON.
+        """
+        response = yield treq.get(nest_account['urls']['transport_url'] + "/v2/mobile/user." + nest_account['userid'],
+                                  headers={"user-agent": NEST_USER_AGENT,
+                                           "Authorization": "Basic " + nest_account['access_token'],
+                                           "X-nl-user-id": nest_account['userid'],
+                                           "X-nl-protocol-version": NEST_PROTOCOL_VERSION}
+                                  )
+        content = yield treq.content(response)
+        returnValue((response.code, content))
+
+    @inlineCallbacks
+    def poll_account(self, request):
+        account_hash = request['account']
+        for serial in request.get('resync', []):
+            self.last_sent.pop(serial, None)
+        success = True
+        try:
+            nest_account = yield self.login(request)
+            code, content = yield self.fetch(nest_account)
+            if code != 401:
+                content = self.decode(content)
+            if code == 401 or 'error' in content:  # Token may have expired, try once more.
+                nest_account = yield self.login(request, force_login=True)
+                code, content = yield self.fetch(nest_account)
+                if code == 401:
+                    raise Exception("NEST rejected the login token for this account.")
+                content = self.decode(content)
+            if 'error' in content:
+                raise Exception("Error with NEST Request: %s" % content['error_description'])
+
+            for serial in request['serials']:
+                structure_id = content['link'][serial]['structure'].split('.')[-1]
+                delta = self.delta(serial, {
+                    'shared': content['shared'][serial],
+                    'device': content['device'][serial],
+                    'structure': dict(content['structure'][structure_id], structure_id=structure_id),
+                })
+                if len(delta):
+                    self.send({'account': account_hash, 'serial': serial, 'delta': delta})
+        except Exception as e:
+            success = False
+            self.send({'account': account_hash, 'error': str(e)})
+        self.send({'account': account_hash, 'done': True, 'success': success})
+
+    def decode(self, content):
+        try:
+            return json.loads(content)
+        except ValueError:
+            return {'error': True, 'error_description': "Invalid response from NEST."}
+
+    def delta(self, serial, data):
+        """
+        Returns only the values that have changed since the last time this serial was sent.
+        """
+        if serial not in self.last_sent:
+            self.last_sent[serial] = {}
+        last_sent = self.last_sent[serial]
+
+        delta = {}
+        for section, values in data.items():
+            if section not in last_sent:
+                last_sent[section] = {}
+            changed = {key: value for key, value in values.items()
+                       if key not in last_sent[section] or last_sent[section][key] != value}
+            if len(changed):
+                delta[section] = changed
+                last_sent[section].update(changed)
+        return delta
+
+
+if __name__ == "__main__":
+    stdio.StandardIO(PollWorker())
+    reactor.run()